@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Warm up the in-memory rate limits once the apps are loaded, only in the processes serving requests
+if settings.RATE_LIMITS_IN_MEMORY:
+    from rates.service import InMemoryRateLimitsService
+    InMemoryRateLimitsService().start()
@@ -29,6 +29,10 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.getenv('DEBUG', False) == 'True'
 
+# Keep the rate limit state in process memory instead of counting Notifications on every check.
+# Only valid for single-node deployments, since every process keeps its own state.
+RATE_LIMITS_IN_MEMORY = os.getenv('RATE_LIMITS_IN_MEMORY', False) == 'True'
+
 ALLOWED_HOSTS = []
 
 
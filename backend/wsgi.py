@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Warm up the in-memory rate limits once the apps are loaded, only in the processes serving requests
+if settings.RATE_LIMITS_IN_MEMORY:
+    from rates.service import InMemoryRateLimitsService
+    InMemoryRateLimitsService().start()
@@ -2,7 +2,7 @@ import logging
 import uuid
 from notifications.models import Notification, NotificationType
 from datetime import datetime
-from rates.service import RateLimitsService, RateLimitError
+from rates.service import RateLimitError, get_rate_limits_service
 from clients.service import ClientsService, ClientDoesNotExistError
 
 logger = logging.getLogger(__name__)
@@ -22,7 +22,7 @@ class NotificationsService:
         can be sent to the provided Client.
 
         If everything is ok, create a Notification of the specific type to the provided Client with
-        the provided message and set the datetime as the current datetime.
+        the provided message and set the datetime as the current datetime, and record it in the RateLimitsService.
         """
         try:
             client = ClientsService().get_client_by_uuid(uuid=client_uuid)
@@ -35,17 +35,19 @@ class NotificationsService:
             logger.error(f'Notification type {notif_type} does not exist')
             raise IncorrectNotificationTypeError
 
+        rates_service = get_rate_limits_service()
         try:
-            RateLimitsService().check_if_rate_is_ok(notif_type_obj, client_uuid)
+            rates_service.check_if_rate_is_ok(notif_type_obj, client_uuid)
         except RateLimitError:
             logger.warning(f'Notification of type {notif_type} cannot be sent to client {client_uuid} due to rate limits')
             raise
         
-        Notification.objects.create(
+        notification = Notification.objects.create(
             client=client,
             notification_type=notif_type_obj,
             message=message,
             datetime=datetime.now()
         )
+        rates_service.record_notification(notification)
         logger.info(f'Notification of type {notif_type} sent to client {client_uuid} successfully')
         return
\ No newline at end of file
@@ -1,11 +1,11 @@
 import uuid
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from unittest.mock import patch
 from notifications.models import Notification, NotificationType
 from notifications.service import NotificationsService, IncorrectNotificationTypeError
 from clients.models import Client
 from clients.service import ClientDoesNotExistError
-from rates.service import RateLimitError
+from rates.service import RateLimitError, InMemoryRateLimitsService
 
 EXAMPLE_NAME = 'TEST'
 EXAMPLE_EMAIL = 'someexample@miemail.com'
@@ -45,6 +45,20 @@ class NotificationsServiceTests(TestCase):
             mock_logger.warning.assert_called_with(f'Notification of type {EXAMPLE_NAME} cannot be sent to client {client.uuid} due to rate limits')        
             self.assertEqual(Notification.objects.count(), 0)
 
+    @override_settings(RATE_LIMITS_IN_MEMORY=True)
+    def test_send_notification_in_memory_rate_limits(self, mock_logger):
+        InMemoryRateLimitsService._rings.clear()
+        InMemoryRateLimitsService._loading.clear()
+        self.addCleanup(InMemoryRateLimitsService._rings.clear)
+        self.addCleanup(InMemoryRateLimitsService._loading.clear)
+        NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=100)
+        client = Client.objects.create(email=EXAMPLE_EMAIL)
+        InMemoryRateLimitsService().warm_up()
+        NotificationsService().send_notification(notif_type=EXAMPLE_NAME, client_uuid=client.uuid, message='Hello world')
+        with self.assertRaises(RateLimitError):
+            NotificationsService().send_notification(notif_type=EXAMPLE_NAME, client_uuid=client.uuid, message='Hello world')
+        self.assertEqual(Notification.objects.count(), 1)
+
     def test_send_notification_error_client_does_not_exist(self, mock_logger):
         random_uuid = uuid.uuid4()
         NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=100)
@@ -1,7 +1,12 @@
 import logging
+import threading
+import time
 import uuid
+from array import array
 from datetime import datetime, timedelta
 from notifications.models import Notification, NotificationType
+from django.conf import settings
+from django.db import connections
 from django.db.utils import IntegrityError
 from django.utils import timezone
 logger = logging.getLogger(__name__)
@@ -71,3 +76,458 @@ class RateLimitsService:
             raise RateLimitError
         
         return True
+
+    def record_notification(self, notification: Notification):
+        """
+        Record a Notification that was just sent.
+        The Notifications are counted directly in the database, so there is nothing else to record.
+        """
+        return
+
+
+class _Table:
+    """
+    Open-addressed hash table of clients, with a fixed-size ring of send timestamps per bucket.
+    Every field is packed into arrays, so no Python object is kept per client or per notification.
+    The ring of bucket i starts at timestamps[i * size] and heads[i] points to its oldest timestamp.
+    A bucket takes 19 + 8 * size bytes.
+    """
+    EMPTY, USED, DELETED = 0, 1, 2
+
+    def __init__(self, capacity: int, size: int):
+        self.capacity = capacity
+        self.size = size
+        self.shift = 64 - (capacity.bit_length() - 1)
+        self.used = 0
+        self.filled = 0
+        self.states = array('B', bytes(capacity))
+        self.keys_high = array('Q', bytes(8 * capacity))
+        self.keys_low = array('Q', bytes(8 * capacity))
+        self.heads = array('H', bytes(2 * capacity))
+        self.timestamps = array('d', bytes(8 * capacity * size))
+
+    def _index(self, high: int, low: int):
+        # Fibonacci hashing, so every bit of the uuid is used to pick the bucket
+        return ((high ^ low) * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF) >> self.shift
+
+    def lookup(self, high: int, low: int):
+        """
+        Return the bucket of the client, or -1 if the client is not in the table.
+        """
+        mask = self.capacity - 1
+        i = self._index(high, low)
+        while True:
+            state = self.states[i]
+            if state == self.EMPTY:
+                return -1
+            if state == self.USED and self.keys_high[i] == high and self.keys_low[i] == low:
+                return i
+            i = (i + 1) & mask
+
+    def place(self, high: int, low: int):
+        """
+        Store the client in the first free bucket of its probe sequence, and return it.
+        """
+        mask = self.capacity - 1
+        i = self._index(high, low)
+        while self.states[i] == self.USED:
+            i = (i + 1) & mask
+        if self.states[i] == self.EMPTY:
+            self.filled += 1
+        self.states[i] = self.USED
+        self.keys_high[i] = high
+        self.keys_low[i] = low
+        self.used += 1
+        return i
+
+    def remove(self, i: int):
+        self.states[i] = self.DELETED
+        self.used -= 1
+
+    def newest(self, i: int):
+        return self.timestamps[i * self.size + (self.heads[i] - 1) % self.size]
+
+class _TimestampRings:
+    """
+    Send timestamps of every client for a single NotificationType.
+    The table is resized incrementally: the new table is allocated ahead of time by the eviction thread, and
+    the clients are moved from the old one a few buckets per push and a batch per eviction tick,
+    so no call does O(N) work while holding the lock. Lookups check both tables until the old one is empty.
+    """
+    MIN_CAPACITY = 8
+    MIN_MIGRATION_BATCH_SIZE = 8
+
+    def __init__(self, size: int, window: float, keys: int = 0):
+        self.size = size
+        self.window = window
+        self.lock = threading.Lock()
+        self.table = _Table(self._capacity_for(keys), size)
+        self.old = None
+        self.spare = None
+        self.migration_cursor = 0
+        self.migration_batch_size = self.MIN_MIGRATION_BATCH_SIZE
+        self.eviction_cursor = 0
+        self._empty_ring = array('d', bytes(8 * size))
+
+    def _capacity_for(self, keys: int):
+        """
+        Return the capacity that leaves the given amount of clients at most half of the table.
+        """
+        capacity = self.MIN_CAPACITY
+        while capacity < 2 * keys:
+            capacity *= 2
+        return capacity
+
+    @property
+    def used(self):
+        return self.table.used + (self.old.used if self.old is not None else 0)
+
+    def _move(self, j: int):
+        """
+        Move bucket j of the old table to the current one, and return its new bucket.
+        """
+        old, table, size = self.old, self.table, self.size
+        i = table.place(old.keys_high[j], old.keys_low[j])
+        table.heads[i] = old.heads[j]
+        table.timestamps[i * size:(i + 1) * size] = old.timestamps[j * size:(j + 1) * size]
+        old.remove(j)
+        return i
+
+    def migrate(self, max_buckets: int):
+        """
+        Move the clients of at most max_buckets buckets of the old table, and drop it once they are all moved.
+        """
+        if self.old is None:
+            return
+
+        end = min(self.migration_cursor + max_buckets, self.old.capacity)
+        for j in range(self.migration_cursor, end):
+            if self.old.states[j] == _Table.USED:
+                self._move(j)
+
+        self.migration_cursor = end
+        if end == self.old.capacity:
+            self.old = None
+
+    def _resize(self, capacity: int):
+        """
+        Start moving every client to a new table with the given capacity, using the spare table if it fits.
+        The clients are moved fast enough to be done before the pushes fill 3/4 of the new table.
+        """
+        if self.old is not None:
+            self.migrate(self.old.capacity)
+
+        self.old = self.table
+        if self.spare is not None and self.spare.capacity == capacity:
+            self.table = self.spare
+        else:
+            self.table = _Table(capacity, self.size)
+        self.spare = None
+        self.migration_cursor = 0
+        free_buckets = 3 * capacity // 4 - self.old.used
+        self.migration_batch_size = max(self.MIN_MIGRATION_BATCH_SIZE, -(-self.old.capacity // free_buckets))
+
+    def _is_sparse(self):
+        return self.table.capacity > self.MIN_CAPACITY and 8 * (self.table.used + 1) <= self.table.capacity
+
+    def next_capacity(self):
+        """
+        Return the capacity of the next resize if it is due soon and its spare table is not allocated yet.
+        The table shrinks when it is less than 1/8 full, down to a quarter of its capacity at most per resize,
+        and grows when the pushes fill 3/4 of it, so the spare is prepared from 5/8.
+        """
+        if self.old is not None or not self.size:
+            return None
+
+        table = self.table
+        if self._is_sparse():
+            capacity = max(self._capacity_for(table.used + 1), table.capacity // 4)
+        elif 8 * (table.filled + 1) > 5 * table.capacity:
+            capacity = max(self._capacity_for(table.used + 1), table.capacity)
+        else:
+            # No resize is coming anymore, so do not keep the spare allocated
+            self.spare = None
+            return None
+
+        if self.spare is not None and self.spare.capacity == capacity:
+            return None
+        return capacity
+
+    def shrink(self):
+        """
+        Start shrinking the table into the spare table if it is less than 1/8 full.
+        """
+        if self.old is None and self.spare is not None and self.spare.capacity < self.table.capacity and self._is_sparse():
+            self._resize(self.spare.capacity)
+
+    def push(self, high: int, low: int, timestamp: float):
+        """
+        Store a timestamp in the ring of the client, overwriting its oldest one.
+        """
+        if not self.size:
+            return
+
+        self.migrate(self.migration_batch_size)
+        table = self.table
+        i = table.lookup(high, low)
+        if i == -1 and self.old is not None:
+            j = self.old.lookup(high, low)
+            if j != -1:
+                i = self._move(j)
+        if i == -1:
+            if 4 * (table.filled + 1) > 3 * table.capacity:
+                # Grow, or just drop the evicted buckets if at most half of the table is used
+                self._resize(max(self._capacity_for(table.used + 1), table.capacity))
+                table = self.table
+            i = table.place(high, low)
+            table.heads[i] = 0
+            table.timestamps[i * self.size:(i + 1) * self.size] = self._empty_ring
+
+        head = table.heads[i]
+        table.timestamps[i * self.size + head] = timestamp
+        table.heads[i] = (head + 1) % self.size
+
+    def is_allowed(self, high: int, low: int, now: float):
+        """
+        Return whether the oldest of the last `size` timestamps of the client is out of the window.
+        """
+        if not self.size:
+            return False
+
+        table = self.table
+        i = table.lookup(high, low)
+        if i == -1 and self.old is not None:
+            table = self.old
+            i = table.lookup(high, low)
+        return i == -1 or table.timestamps[i * self.size + table.heads[i]] < now - self.window
+
+    def evict_idle(self, now: float, max_buckets: int):
+        """
+        Release the clients whose newest timestamp is out of the window, so their buckets can be reused.
+        At most max_buckets buckets of the current table are swept, starting where the previous call stopped.
+        """
+        if not self.size:
+            return 0
+
+        date_from = now - self.window
+        table = self.table
+        evicted = 0
+        i = self.eviction_cursor % table.capacity
+        for _ in range(min(max_buckets, table.capacity)):
+            if table.states[i] == _Table.USED and table.newest(i) < date_from:
+                table.remove(i)
+                evicted += 1
+            i = (i + 1) % table.capacity
+
+        self.eviction_cursor = i
+        return evicted
+
+    def matches(self, notif_type: object):
+        return self.size == notif_type.max_times_allowed and self.window == notif_type.minutes * 60
+
+def _split_uuid(client_uuid: uuid.UUID):
+    if not isinstance(client_uuid, uuid.UUID):
+        client_uuid = uuid.UUID(str(client_uuid))
+    return client_uuid.int >> 64, client_uuid.int & 0xFFFFFFFFFFFFFFFF
+
+class InMemoryRateLimitsService(RateLimitsService):
+    """
+    RateLimitsService that keeps the rate limits state in memory instead of counting Notifications
+    in the database on every check.
+    The state is shared by every instance in the process, so it is only valid for single-node deployments.
+    """
+    EVICTION_BATCH_SIZE = 10000
+    EVICTION_PAUSE_SECONDS = 0.1
+    # Longest time a send can take between getting its datetime and being recorded
+    LOAD_REPLAY_MARGIN_SECONDS = 60
+
+    # NotificationType pk -> _TimestampRings
+    _rings = {}
+    # NotificationType pk -> sends recorded while the type is being loaded
+    _loading = {}
+    # Guards _rings and _loading. Each _TimestampRings has its own lock for its content
+    _lock = threading.Lock()
+
+    def _load_rings(self, notif_type: object):
+        """
+        Create the rings of a notification type from the Notifications sent inside its current window,
+        without holding any lock, and then add the sends recorded meanwhile that the query did not return.
+        """
+        date_to = timezone.now()
+        # Only the sends recorded during the load can be missing from the query, and they are all this recent
+        recent_from = date_to - timedelta(seconds=self.LOAD_REPLAY_MARGIN_SECONDS)
+        recent_pks = set()
+        try:
+            sent = Notification.objects.filter(
+                notification_type=notif_type,
+                datetime__gte=date_to - timedelta(minutes=notif_type.minutes)
+            )
+            rings = _TimestampRings(
+                size=notif_type.max_times_allowed,
+                window=notif_type.minutes * 60,
+                keys=sent.values('client_id').distinct().count() if notif_type.max_times_allowed else 0
+            )
+            if rings.size:
+                sent = sent.order_by('datetime').values_list('pk', 'client_id', 'datetime')
+                for pk, client_uuid, sent_at in sent.iterator():
+                    rings.push(*_split_uuid(client_uuid), sent_at.timestamp())
+                    if sent_at >= recent_from:
+                        recent_pks.add(pk)
+        except Exception:
+            with self._lock:
+                self._loading.pop(notif_type.pk, None)
+            raise
+
+        recent_from = recent_from.timestamp()
+        with self._lock:
+            for pk, high, low, timestamp in self._loading.pop(notif_type.pk, []):
+                if timestamp >= recent_from and pk not in recent_pks:
+                    rings.push(high, low, timestamp)
+            self._rings[notif_type.pk] = rings
+
+        logger.info(f'Rate limits of notification type {notif_type.name} loaded in memory')
+        return rings
+
+    def _load_rings_in_background(self, notif_type: object):
+        try:
+            self._load_rings(notif_type)
+        except Exception:
+            logger.exception(f'Rate limits of notification type {notif_type.name} could not be loaded in memory')
+        finally:
+            connections.close_all()
+
+    def _start_load(self, notif_type: object):
+        threading.Thread(
+            target=self._load_rings_in_background,
+            args=(notif_type,),
+            name='rate-limits-load',
+            daemon=True
+        ).start()
+
+    def _get_rings(self, notif_type: object, wait: bool = False):
+        """
+        Return the rings of a notification type, loading them if they are missing or its rate was edited.
+        Unless wait is True, the load runs in another thread and None is returned meanwhile,
+        as it is when another thread is already loading them.
+        """
+        with self._lock:
+            rings = self._rings.get(notif_type.pk)
+            if rings is not None and rings.matches(notif_type):
+                return rings
+            if notif_type.pk in self._loading:
+                return None
+            self._loading[notif_type.pk] = []
+
+        if wait:
+            return self._load_rings(notif_type)
+        self._start_load(notif_type)
+        return None
+
+    def warm_up(self):
+        """
+        Load the current windows of every NotificationType, so the checks do not hit the database.
+        """
+        for notif_type in NotificationType.objects.all():
+            self._get_rings(notif_type, wait=True)
+
+    def evict_idle(self, max_buckets: int = EVICTION_BATCH_SIZE):
+        """
+        Release the state of the clients that did not receive any notification inside the window of each type,
+        and prepare, start or continue the resize of the tables of each type.
+        At most max_buckets buckets of each type are swept per call, so the locks are only held briefly.
+        """
+        now = timezone.now().timestamp()
+        with self._lock:
+            all_rings = list(self._rings.values())
+
+        evicted = 0
+        for rings in all_rings:
+            with rings.lock:
+                evicted += rings.evict_idle(now, max_buckets)
+                rings.migrate(max_buckets)
+                capacity = rings.next_capacity()
+            if capacity is None:
+                continue
+
+            # Allocate the next table without holding the lock, so the pushes do not wait for it
+            table = _Table(capacity, rings.size)
+            with rings.lock:
+                rings.spare = table
+                rings.shrink()
+        return evicted
+
+    def _run(self):
+        try:
+            self.warm_up()
+        except Exception:
+            logger.exception('Rate limits warm up failed, notification types will be loaded on their first check')
+        finally:
+            connections.close_all()
+
+        while True:
+            time.sleep(self.EVICTION_PAUSE_SECONDS)
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception('Rate limits eviction failed')
+
+    def start(self):
+        """
+        Warm up the rate limits and keep evicting idle clients in a background thread.
+        Meant to be called once per process at startup.
+        """
+        threading.Thread(target=self._run, name='rate-limits', daemon=True).start()
+
+    def check_if_rate_is_ok(
+            self,
+            notif_type: object,
+            client_uuid: uuid.UUID,
+        ):
+        """
+        Check if a certain notification type can be sent to a user, based on rate limits.
+        The last max_times_allowed send timestamps of the client are kept in memory, so the notification can be
+        sent if the oldest of them is out of the window.
+        While the type is being loaded, the Notifications are counted in the database instead.
+        Otherwise, raise a custom RateLimitError exception.
+        """
+        high, low = _split_uuid(client_uuid)
+        now = timezone.now().timestamp()
+
+        rings = self._get_rings(notif_type)
+        if rings is None:
+            return super().check_if_rate_is_ok(notif_type, client_uuid)
+
+        with rings.lock:
+            allowed = rings.is_allowed(high, low, now)
+        if not allowed:
+            raise RateLimitError
+
+        return True
+
+    def record_notification(self, notification: Notification):
+        """
+        Record a Notification that was just sent in the ring of its client.
+        If its type is being loaded, keep it to be added once the load finishes.
+        If its type was never loaded, it will be read from the database when it is.
+        """
+        high, low = _split_uuid(notification.client_id)
+        timestamp = notification.datetime.timestamp()
+
+        with self._lock:
+            loading = self._loading.get(notification.notification_type_id)
+            if loading is not None:
+                loading.append((notification.pk, high, low, timestamp))
+                return
+            rings = self._rings.get(notification.notification_type_id)
+
+        if rings is not None:
+            with rings.lock:
+                rings.push(high, low, timestamp)
+
+def get_rate_limits_service():
+    """
+    Return the RateLimitsService to use, depending on the RATE_LIMITS_IN_MEMORY setting.
+    """
+    if settings.RATE_LIMITS_IN_MEMORY:
+        return InMemoryRateLimitsService()
+    return RateLimitsService()
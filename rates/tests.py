@@ -1,9 +1,11 @@
+from datetime import timedelta
 from django.db import transaction
 from django.db.utils import IntegrityError
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from unittest.mock import patch
-from notifications.models import NotificationType
-from rates.service import RateLimitsService, RateLimitError
+from notifications.models import Notification, NotificationType
+from rates.service import RateLimitsService, RateLimitError, InMemoryRateLimitsService, get_rate_limits_service
 from clients.models import Client
 
 EXAMPLE_NAME = 'TEST'
@@ -70,4 +72,169 @@ class RateLimitsServiceTests(TestCase):
         client = Client.objects.create(email='someexample@miemail.com')
         
         with self.assertRaises(RateLimitError):
-            RateLimitsService().check_if_rate_is_ok(notif_type_obj, client.uuid)
\ No newline at end of file
+            RateLimitsService().check_if_rate_is_ok(notif_type_obj, client.uuid)
+
+@patch('rates.service.logger')
+class InMemoryRateLimitsServiceTests(TestCase):
+    def setUp(self):
+        InMemoryRateLimitsService._rings.clear()
+        InMemoryRateLimitsService._loading.clear()
+        self.addCleanup(InMemoryRateLimitsService._rings.clear)
+        self.addCleanup(InMemoryRateLimitsService._loading.clear)
+        # The test database is only visible from this thread, so the lazy loads are run by the tests
+        start_load_patcher = patch.object(InMemoryRateLimitsService, '_start_load')
+        self.mock_start_load = start_load_patcher.start()
+        self.addCleanup(start_load_patcher.stop)
+        self.client_obj = Client.objects.create(email='someexample@miemail.com')
+
+    def send(self, notif_type_obj, client):
+        notification = Notification.objects.create(notification_type=notif_type_obj, client=client, message='Hello')
+        InMemoryRateLimitsService().record_notification(notification)
+        return notification
+
+    def test_check_if_rate_is_ok_ok(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=60)
+        InMemoryRateLimitsService().warm_up()
+
+        self.assertTrue(InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid))
+        # Checking does not count as a send
+        self.assertTrue(InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid))
+        mock_logger.info.assert_called_with(f'Rate limits of notification type {EXAMPLE_NAME} loaded in memory')
+
+    def test_check_if_rate_is_ok_raises_error_after_max_times(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=2, minutes=60)
+        other_client = Client.objects.create(email='other@miemail.com')
+        InMemoryRateLimitsService().warm_up()
+        self.send(notif_type_obj, self.client_obj)
+        self.send(notif_type_obj, self.client_obj)
+
+        with self.assertRaises(RateLimitError):
+            InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+        self.assertTrue(InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, other_client.uuid))
+
+    def test_check_if_rate_is_ok_raises_error_zero_max_times(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=0, minutes=60)
+        InMemoryRateLimitsService().warm_up()
+
+        with self.assertRaises(RateLimitError):
+            InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+
+    def test_warm_up_loads_sent_notifications(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=60)
+        Notification.objects.create(notification_type=notif_type_obj, client=self.client_obj, message='Hello')
+        InMemoryRateLimitsService().warm_up()
+        self.assertIn(notif_type_obj.pk, InMemoryRateLimitsService._rings)
+        self.mock_start_load.assert_not_called()
+
+        with self.assertRaises(RateLimitError):
+            InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+
+    def test_check_if_rate_is_ok_loads_in_background(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=60)
+        Notification.objects.create(notification_type=notif_type_obj, client=self.client_obj, message='Hello')
+
+        # The Notifications are counted in the database until the load finishes
+        with self.assertRaises(RateLimitError):
+            InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+        self.mock_start_load.assert_called_once_with(notif_type_obj)
+        self.assertIn(notif_type_obj.pk, InMemoryRateLimitsService._loading)
+        self.assertNotIn(notif_type_obj.pk, InMemoryRateLimitsService._rings)
+
+        InMemoryRateLimitsService()._load_rings(notif_type_obj)
+        self.assertNotIn(notif_type_obj.pk, InMemoryRateLimitsService._loading)
+        with self.assertRaises(RateLimitError):
+            InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+        self.mock_start_load.assert_called_once()
+
+    def test_check_if_rate_is_ok_reloads_edited_rate(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=60)
+        Notification.objects.create(notification_type=notif_type_obj, client=self.client_obj, message='Hello')
+        InMemoryRateLimitsService().warm_up()
+        with self.assertRaises(RateLimitError):
+            InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+
+        RateLimitsService().edit_notification_type_rate(name=EXAMPLE_NAME, max_times=2, minutes=60)
+        notif_type_obj.refresh_from_db()
+        self.assertTrue(InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid))
+        self.mock_start_load.assert_called_once_with(notif_type_obj)
+
+        InMemoryRateLimitsService()._load_rings(notif_type_obj)
+        self.send(notif_type_obj, self.client_obj)
+        with self.assertRaises(RateLimitError):
+            InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+
+    def test_load_replays_sends_missing_from_the_query(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=2, minutes=60)
+        other_client = Client.objects.create(email='other@miemail.com')
+        InMemoryRateLimitsService._loading[notif_type_obj.pk] = []
+        # Recorded during the load and returned by its query, so it must not be counted twice
+        self.send(notif_type_obj, other_client)
+        # Recorded during the load with a datetime before the load started, but committed after its query
+        notification = self.send(notif_type_obj, self.client_obj)
+        Notification.objects.filter(pk=notification.pk).delete()
+        self.send(notif_type_obj, self.client_obj)
+        self.assertEqual(len(InMemoryRateLimitsService._loading[notif_type_obj.pk]), 3)
+
+        with patch('rates.service.timezone.now', return_value=timezone.now() + timedelta(seconds=1)):
+            InMemoryRateLimitsService()._load_rings(notif_type_obj)
+            with self.assertRaises(RateLimitError):
+                InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+            self.assertTrue(InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, other_client.uuid))
+
+    def test_evict_idle_ok(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=60)
+        InMemoryRateLimitsService().warm_up()
+        for i in range(3):
+            self.send(notif_type_obj, Client.objects.create(email=f'client_{i}@miemail.com'))
+        self.send(notif_type_obj, self.client_obj)
+        self.assertEqual(InMemoryRateLimitsService().evict_idle(), 0)
+
+        with patch('rates.service.timezone.now', return_value=timezone.now() + timedelta(minutes=61)):
+            # Checking never evicts, that is left to the background thread
+            self.assertTrue(InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid))
+            self.assertEqual(InMemoryRateLimitsService._rings[notif_type_obj.pk].used, 4)
+
+            # Each call sweeps a bounded amount of buckets, resuming where the previous one stopped
+            capacity = InMemoryRateLimitsService._rings[notif_type_obj.pk].table.capacity
+            evicted = InMemoryRateLimitsService().evict_idle(max_buckets=capacity // 2)
+            evicted += InMemoryRateLimitsService().evict_idle(max_buckets=capacity // 2)
+            self.assertEqual(evicted, 4)
+            self.assertEqual(InMemoryRateLimitsService._rings[notif_type_obj.pk].used, 0)
+            self.assertTrue(InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid))
+
+    def test_evict_idle_shrinks_table(self, mock_logger):
+        notif_type_obj = NotificationType.objects.create(name=EXAMPLE_NAME, max_times_allowed=1, minutes=60)
+        InMemoryRateLimitsService().warm_up()
+        for i in range(50):
+            self.send(notif_type_obj, Client.objects.create(email=f'client_{i}@miemail.com'))
+        self.send(notif_type_obj, self.client_obj)
+        rings = InMemoryRateLimitsService._rings[notif_type_obj.pk]
+        self.assertEqual(rings.table.capacity, 128)
+
+        with patch('rates.service.timezone.now', return_value=timezone.now() + timedelta(minutes=61)):
+            InMemoryRateLimitsService().evict_idle(max_buckets=rings.table.capacity)
+            self.send(notif_type_obj, self.client_obj)
+            while rings.table.capacity > rings.MIN_CAPACITY or rings.old is not None:
+                InMemoryRateLimitsService().evict_idle(max_buckets=16)
+            with self.assertRaises(RateLimitError):
+                InMemoryRateLimitsService().check_if_rate_is_ok(notif_type_obj, self.client_obj.uuid)
+        self.assertEqual(rings.used, 1)
+
+    def test_run_warms_up_and_keeps_evicting(self, mock_logger):
+        with (
+            patch.object(InMemoryRateLimitsService, 'warm_up') as mock_warm_up,
+            patch.object(InMemoryRateLimitsService, 'evict_idle', side_effect=[0, ValueError, SystemExit]) as mock_evict_idle,
+            patch('rates.service.time.sleep'),
+            patch('rates.service.connections'),
+        ):
+            with self.assertRaises(SystemExit):
+                InMemoryRateLimitsService()._run()
+        mock_warm_up.assert_called_once()
+        self.assertEqual(mock_evict_idle.call_count, 3)
+        mock_logger.exception.assert_called_once_with('Rate limits eviction failed')
+
+    def test_get_rate_limits_service_ok(self, mock_logger):
+        with override_settings(RATE_LIMITS_IN_MEMORY=False):
+            self.assertIs(type(get_rate_limits_service()), RateLimitsService)
+        with override_settings(RATE_LIMITS_IN_MEMORY=True):
+            self.assertIs(type(get_rate_limits_service()), InMemoryRateLimitsService)